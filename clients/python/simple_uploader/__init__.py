@@ -1,4 +1,20 @@
-from .simple_uploader import SimpleUploader
+from .simple_uploader import (
+    CheckResult,
+    FileMeta,
+    Options,
+    Progress,
+    Response,
+    SimpleUploader,
+    Slice,
+)
 
 __version__ = "0.0.15"
-__all__ = ["SimpleUploader"]
+__all__ = [
+    "CheckResult",
+    "FileMeta",
+    "Options",
+    "Progress",
+    "Response",
+    "SimpleUploader",
+    "Slice",
+]
@@ -1,13 +1,35 @@
 import hashlib
-import io
-import json
+import mmap
 import os
-from dataclasses import asdict, dataclass
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Generic, List, Optional, Tuple, TypeVar, Union
 
+import msgspec
 import requests
-from dacite import from_dict
+from requests.adapters import HTTPAdapter
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+from urllib3.util.retry import Retry
+
+# the local meta is flushed after this many finished slices or seconds,
+# and always once an upload stops
+_SAVE_META_EVERY_SLICES = 32
+_SAVE_META_EVERY_SECONDS = 2.0
+
+# with Options.compress, slices are only gzipped if this much of the first
+# pending slice shrinks to at most the given ratio
+_COMPRESS_SAMPLE_SIZE = 1024 * 1024
+_COMPRESS_MAX_RATIO = 0.9
+
+# transient statuses that requests are retried on
+_RETRY_STATUS = [429, 500, 502, 503, 504]
+
+T = TypeVar("T")
 
 
 @dataclass
@@ -23,15 +45,13 @@ class Progress:
     finished_slice: int
 
 
-@dataclass
-class Slice:
+class Slice(msgspec.Struct):
     slice_id: str
     status: int
     sha1: str
 
 
-@dataclass
-class FileMeta:
+class FileMeta(msgspec.Struct):
     file_id: str
     file_name: str
     file_type: str
@@ -41,6 +61,9 @@ class FileMeta:
     created_at: int
     status: int
     slices: Dict[str, Slice]
+    # only used by the local cache, which stores finished slices as a hex bitmap
+    # instead of the whole slices dict
+    done_bitmap: str = ""
 
 
 @dataclass
@@ -50,13 +73,55 @@ class Options:
     on_progress: Optional[Callable[[Progress], None]] = None
     prefix: Optional[str] = ""
     headers: Optional[Dict[str, str]] = None
+    concurrent: Optional[int] = 4
+    compress: Optional[bool] = False
 
 
-@dataclass
-class Response:
+class Response(msgspec.Struct, Generic[T]):
     code: int
     message: str
-    data: Optional[Any] = None
+    data: Optional[T] = None
+
+
+# multipart/form-data body that is sent part by part, so the slice view goes
+# to the socket as is instead of being copied into one encoded body
+class _MultipartStream:
+    def __init__(
+        self, boundary: str, fields: Dict[str, Any], file: memoryview, file_name: str
+    ):
+        self.boundary = boundary
+        self.file = file
+        self.parts: List[Union[bytes, memoryview]] = []
+        for name, value in fields.items():
+            self.parts.append(self._part_header(RequestField(name, value)))
+            self.parts.append(f"{value}\r\n".encode())
+        self.parts.append(
+            self._part_header(RequestField("file", file, filename=file_name))
+        )
+        self.parts.append(file)
+        self.parts.append(f"\r\n--{self.boundary}--\r\n".encode())
+
+    def _part_header(self, field: RequestField) -> bytes:
+        field.make_multipart()
+        return f"--{self.boundary}\r\n{field.render_headers()}".encode()
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.release()
+
+    def gzip(self) -> bytes:
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        chunks = [compressor.compress(part) for part in self.parts]
+        chunks.append(compressor.flush())
+        return b"".join(chunks)
 
 
 class SimpleUploader:
@@ -65,40 +130,164 @@ class SimpleUploader:
     meta: FileMeta
     meta_key: str
     meta_file: Path
+    slice_ranges: Dict[str, Tuple[int, int]]
+    done: bytearray
+    finished_slice: int
+    unsaved_slice: int
+    last_saved_at: float
+    compress: bool
 
     def __init__(
         self, file: Union[Path, str], options: Optional[Union[dict, Options]] = {}
     ):
         self.file = Path(file)
-        self.fh = self.file.open("rb")
-        self.file_size = os.path.getsize(self.file)
-        if isinstance(options, dict):
+        # an unbuffered file object instead of a raw fd, so the descriptor is
+        # still freed on garbage collection if close() is never called
+        self.fh = open(self.file, "rb", buffering=0)
+        self.file_size = os.fstat(self.fh.fileno()).st_size
+        # zero-length files can not be mapped, they have no slices anyway
+        self.mm = (
+            mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.file_size
+            else None
+        )
+        if options is None:
+            self.options = Options()
+        elif isinstance(options, dict):
             self.options = Options(**options)
+        else:
+            self.options = options
+        self.view = memoryview(self.mm) if self.mm is not None else None
+        self.slice_ranges = {}
         self.meta = None
+        self.done = bytearray()
+        self.finished_slice = 0
+        self.unsaved_slice = 0
+        self.last_saved_at = time.monotonic()
+        self.compress = False
         self.meta_key = f"file_meta_{self.file.name}_{self.file_size}"
         self.meta_file = (
             Path.home() / ".cache" / "simple_uploader" / (self.meta_key + ".json")
         )
         self.meta_file.parent.mkdir(parents=True, exist_ok=True)
-        self.meta_file.touch(exist_ok=True)
         self.load_meta()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        if self.options.headers is not None:
+            self.session.headers.update(self.options.headers)
+        # only GETs are retried after the request was sent, creating a file is
+        # not idempotent. slice uploads get their own adapter in upload()
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=_RETRY_STATUS,
+                allowed_methods=["GET"],
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # every slice body shares one boundary, so its headers are built once
+        self.boundary = choose_boundary()
+        self.slice_headers = {
+            "Content-Type": f"multipart/form-data; boundary={self.boundary}"
+        }
+        self.gzip_slice_headers = {**self.slice_headers, "Content-Encoding": "gzip"}
+
+    def close(self):
+        self.session.close()
+        try:
+            if self.mm is not None:
+                self.view.release()
+                self.mm.close()
+        finally:
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def clear_meta(self):
         self.meta = None
-        self.meta_file.unlink()
+        self.slice_ranges = {}
+        self.meta_file.unlink(missing_ok=True)
 
     def load_meta(self):
         try:
-            self.meta = from_dict(FileMeta, json.loads(self.meta_file.read_text()))
-        except json.decoder.JSONDecodeError:
-            pass
+            meta = msgspec.json.decode(self.meta_file.read_bytes(), type=FileMeta)
+        except (FileNotFoundError, msgspec.DecodeError):
+            return
+        if meta.chunk_size <= 0:
+            return
+        slice_num = -(-meta.file_size // meta.chunk_size)
+        if meta.done_bitmap:
+            try:
+                done = bytearray.fromhex(meta.done_bitmap)
+            except ValueError:
+                return
+            # a bitmap that does not cover every slice is as unusable as bad json
+            if len(done) != (slice_num + 7) // 8:
+                return
+            self.done = done
+            meta.slices = {
+                str(i): Slice(str(i), self._is_done(i), "") for i in range(slice_num)
+            }
+            meta.done_bitmap = ""
+        else:
+            # older caches store the slices dict, its ids have to be the slices
+            if meta.slices.keys() != {str(i) for i in range(slice_num)}:
+                return
+            self._reset_done(meta)
+        self.meta = meta
+        self._index_slices()
 
     def save_meta(self):
-        self.meta_file.write_text(json.dumps(asdict(self.meta)))
+        self.meta_file.write_bytes(
+            msgspec.json.encode(
+                msgspec.structs.replace(
+                    self.meta, slices={}, done_bitmap=self.done.hex()
+                )
+            )
+        )
+        self.unsaved_slice = 0
+        self.last_saved_at = time.monotonic()
+
+    def _index_slices(self):
+        # (offset, length) of every slice, in the same ids the server uses. the
+        # meta's chunk size wins: a cached upload may have been started with a
+        # different Options.chunk_size
+        chunk_size = self.meta.chunk_size
+        self.slice_ranges = {
+            str(i): (offset, min(chunk_size, self.file_size - offset))
+            for i, offset in enumerate(range(0, self.file_size, chunk_size))
+        }
+
+    def _reset_done(self, meta: FileMeta):
+        self.done = bytearray((len(meta.slices) + 7) // 8)
+        for slice_id, slice in meta.slices.items():
+            if slice.status == 1:
+                self._set_done(int(slice_id))
+
+    def _is_done(self, index: int) -> int:
+        return (self.done[index >> 3] >> (index & 7)) & 1
+
+    def _set_done(self, index: int):
+        self.done[index >> 3] |= 1 << (index & 7)
+
+    def _maybe_save_meta(self):
+        if (
+            self.unsaved_slice >= _SAVE_META_EVERY_SLICES
+            or time.monotonic() - self.last_saved_at >= _SAVE_META_EVERY_SECONDS
+        ):
+            self.save_meta()
 
     def upload(self):
         if not self.meta:
-            response = requests.post(
+            response = self.session.post(
                 self.options.endpoint,
                 json={
                     "file_name": self.file.name,
@@ -107,84 +296,182 @@ class SimpleUploader:
                     "chunk_size": self.options.chunk_size,
                     "prefix": self.options.prefix
                 },
-                headers={
-                    **(self.options.headers if self.options.headers is not None else {})
-                },
             )
             if response.status_code != 200:
                 raise Exception(response.text)
-            self.meta = from_dict(FileMeta, response.json()["data"])
+            self.meta = msgspec.json.decode(
+                response.content, type=Response[FileMeta]
+            ).data
+            self._reset_done(self.meta)
+            self._index_slices()
             self.save_meta()
 
-        for slice_id, slice in self.meta.slices.items():
-            if slice.status == 0:
-                response = self._upload_slice(slice_id)
-                if response.code == 206 or response.code == 200:
-                    self.meta.slices[slice_id].status = 1
-                    self.save_meta()
-                if self.options.on_progress:
-                    self.options.on_progress(
-                        {
-                            "all_slice": len(self.meta.slices),
-                            "finished_slice": len(
-                                list(
-                                    filter(
-                                        lambda s: s.status == 1,
-                                        self.meta.slices.values(),
-                                    )
-                                )
-                            ),
-                        }
-                    )
-
-    def _upload_slice(self, slice_id: str) -> Response:
-        self.fh.seek(int(slice_id) * self.options.chunk_size)
-        bytes = self.fh.read(self.options.chunk_size)
+        # a slice is only re-sent when the server answered with an error status.
+        # after a lost response the server may already have merged the file
+        upload_url = f"{self.options.endpoint}/{self.meta.file_id}/upload"
+        if upload_url not in self.session.adapters:
+            self.session.mount(
+                upload_url,
+                HTTPAdapter(
+                    pool_connections=self.options.concurrent,
+                    pool_maxsize=self.options.concurrent,
+                    max_retries=Retry(
+                        total=5,
+                        read=0,
+                        backoff_factor=0.5,
+                        status_forcelist=_RETRY_STATUS,
+                        allowed_methods=["POST"],
+                        respect_retry_after_header=True,
+                        raise_on_status=False,
+                    ),
+                ),
+            )
+
+        pending = [
+            slice_id
+            for slice_id, slice in self.meta.slices.items()
+            if slice.status == 0
+        ]
+        self.finished_slice = len(self.meta.slices) - len(pending)
+        self.compress = (
+            self.options.compress
+            and len(pending) > 0
+            and self._is_compressible(pending[0])
+        )
+        # while a worker sends its slice, the kernel reads ahead the slice that
+        # the same worker is expected to pick up next
+        prefetch = pending[self.options.concurrent :]
+        with ThreadPoolExecutor(max_workers=self.options.concurrent) as executor:
+            futures = {
+                executor.submit(
+                    self._upload_slice,
+                    slice_id,
+                    prefetch[i] if i < len(prefetch) else None,
+                ): slice_id
+                for i, slice_id in enumerate(pending)
+            }
+            try:
+                for future in as_completed(futures):
+                    self._on_slice_uploaded(futures[future], future.result())
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                with self.lock:
+                    if self.unsaved_slice:
+                        self.save_meta()
+
+    def _on_slice_uploaded(self, slice_id: str, response: Response):
+        with self.lock:
+            if response.code == 206 or response.code == 200:
+                self.meta.slices[slice_id].status = 1
+                self._set_done(int(slice_id))
+                self.finished_slice += 1
+                self.unsaved_slice += 1
+                self._maybe_save_meta()
+            if self.options.on_progress:
+                self.options.on_progress(
+                    Progress(len(self.meta.slices), self.finished_slice)
+                )
+
+    def _upload_slice(
+        self, slice_id: str, prefetch_slice_id: Optional[str] = None
+    ) -> Response:
+        if prefetch_slice_id is not None:
+            self._prefetch_slice(prefetch_slice_id)
         form_data = {
             "slice_id": slice_id,
             "file_id": self.meta.file_id,
             "file_name": self.meta.file_name,
             "file_type": self.meta.file_type,
             "file_size": self.meta.file_size,
-            "chunk_size": self.options.chunk_size,
+            "chunk_size": self.meta.chunk_size,
         }
-        response = requests.post(
-            f"{self.options.endpoint}/{self.meta.file_id}/upload",
-            data=form_data,
-            files={
-                "file": io.BytesIO(bytes),
-            },
-            headers={
-                **(self.options.headers if self.options.headers is not None else {})
-            },
-        )
+        # the view is released on the way out, so a traceback that keeps this
+        # frame alive does not keep the mmap exported and block close()
+        with _MultipartStream(
+            self.boundary, form_data, self._slice_view(slice_id), "file"
+        ) as body:
+            response = self.session.post(
+                f"{self.options.endpoint}/{self.meta.file_id}/upload",
+                data=body.gzip() if self.compress else body,
+                headers=(
+                    self.gzip_slice_headers if self.compress else self.slice_headers
+                ),
+            )
+
+        # once the last slice is in, the server merges the file and drops the
+        # upload, so re-sending any slice of it fails with 422
+        if response.status_code == 422 and self._is_slice_stored(slice_id):
+            return Response(200, "slice already stored")
 
         if response.status_code >= 400:
             raise Exception(response.text)
 
-        return from_dict(Response, response.json())
+        return msgspec.json.decode(response.content, type=Response[Any])
 
-    def _sha1(self, blob: bytes) -> str:
-        sha1 = hashlib.sha1()
-        sha1.update(blob)
-        return sha1.hexdigest()
-
-    def checksum(self) -> CheckResult:
-        response = requests.get(
+    def _server_meta(self) -> FileMeta:
+        response = self.session.get(
             f"{self.options.endpoint}/{self.meta.file_id}/meta",
-            headers={
-                **(self.options.headers if self.options.headers is not None else {})
-            },
         )
-        server_meta = from_dict(FileMeta, response.json()["data"])
-        check_result = CheckResult(0, 0, [])
-        for slice_id, slice in server_meta.slices.items():
-            self.fh.seek(int(slice_id) * self.options.chunk_size)
-            blob = self.fh.read(self.options.chunk_size)
-            sha1 = self._sha1(blob)
-            if slice.sha1 == sha1:
-                check_result.success_count += 1
-            else:
-                check_result.failed_count += 1
-                check_result.failed_slices_id.append(slice_id)
-        return check_result
+        if response.status_code != 200:
+            raise Exception(response.text)
+        return msgspec.json.decode(response.content, type=Response[FileMeta]).data
+
+    def _is_slice_stored(self, slice_id: str) -> bool:
+        try:
+            server_meta = self._server_meta()
+        except Exception:
+            return False
+        slice = server_meta.slices.get(slice_id)
+        return (
+            slice is not None
+            and slice.status == 1
+            and slice.sha1 == self._hash_slice(slice_id)
+        )
+
+    def _sha1(self, blob: Union[bytes, memoryview]) -> str:
+        return hashlib.sha1(blob).hexdigest()
+
+    def _slice_view(self, slice_id: str) -> memoryview:
+        offset, length = self.slice_ranges[slice_id]
+        return self.view[offset : offset + length]
+
+    def _is_compressible(self, slice_id: str) -> bool:
+        with self._slice_view(slice_id) as view, view[:_COMPRESS_SAMPLE_SIZE] as sample:
+            return len(zlib.compress(sample, 1)) <= len(sample) * _COMPRESS_MAX_RATIO
+
+    def _prefetch_slice(self, slice_id: str):
+        # madvise is not available on every platform, e.g. Windows
+        if not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        offset, length = self.slice_ranges[slice_id]
+        start = offset - offset % mmap.PAGESIZE
+        self.mm.madvise(mmap.MADV_WILLNEED, start, offset - start + length)
+
+    def _hash_slice(self, slice_id: str) -> str:
+        with self._slice_view(slice_id) as view:
+            return self._sha1(view)
+
+    def checksum(self) -> CheckResult:
+        server_meta = self._server_meta()
+        # slices the server has not stored yet have no sha1 and can not match
+        stored = [
+            (slice_id, slice.sha1)
+            for slice_id, slice in server_meta.slices.items()
+            if slice.sha1
+        ]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            local_sha1s = executor.map(
+                self._hash_slice, [slice_id for slice_id, _ in stored]
+            )
+            matched = {
+                slice_id
+                for (slice_id, sha1), local_sha1 in zip(stored, local_sha1s)
+                if sha1 == local_sha1
+            }
+        failed_slices_id = [
+            slice_id for slice_id in server_meta.slices if slice_id not in matched
+        ]
+        return CheckResult(len(matched), len(failed_slices_id), failed_slices_id)
@@ -2,12 +2,14 @@ package controllers
 
 import (
 	"bytes"
+	"compress/gzip"
 	"crypto/sha1"
 	"encoding/hex"
 	"encoding/json"
 	"io"
 	"io/ioutil"
 	"mime/multipart"
+	"net/http"
 	"os"
 	"path"
 	"strconv"
@@ -99,6 +101,9 @@ func (f *FileController) Meta(c *gin.Context) {
 
 var filesLock sync.Map
 
+// upper bound of everything but the slice in an upload's multipart body
+const multipartOverhead = 64 * 1024
+
 func init() {
 	filesLock = sync.Map{}
 }
@@ -108,6 +113,40 @@ func (f *FileController) Upload(c *gin.Context) {
 	// print all headers with logrus.Debug
 	logrus.Debugf("headers: %v", c.Request.Header)
 
+	// clients may gzip the whole multipart body of compressible slices
+	if c.GetHeader("Content-Encoding") == "gzip" {
+		// the decompressed body is capped at one chunk plus the form fields,
+		// otherwise a tiny gzip body could fill the disk with spooled parts
+		// read under the file lock, other uploads of the file rewrite meta.json
+		var uploadingMeta FileMeta
+		lockAny, _ := filesLock.LoadOrStore(c.Param("id"), &sync.Mutex{})
+		lock := lockAny.(*sync.Mutex)
+		lock.Lock()
+		content, err := ioutil.ReadFile(path.Join(viper.GetString("uploader.slice_cache_dir"), c.Param("id"), "meta.json"))
+		lock.Unlock()
+		if err != nil {
+			logrus.Errorf("failed to read meta file: %v", err)
+			f.Write(c, nil, 422, 0, "")
+			return
+		}
+		if err = json.Unmarshal(content, &uploadingMeta); err != nil || uploadingMeta.ChunkSize <= 0 {
+			logrus.Errorf("failed to parse meta file: %v", err)
+			f.Write(c, nil, 500, 0, "")
+			return
+		}
+
+		reader, err := gzip.NewReader(c.Request.Body)
+		if err != nil {
+			logrus.Infof("failed to read gzip body: %v", err)
+			f.Write(c, nil, 400, 0, "")
+			return
+		}
+		defer reader.Close()
+		c.Request.Body = http.MaxBytesReader(c.Writer, reader, uploadingMeta.ChunkSize+multipartOverhead)
+		c.Request.ContentLength = -1
+		c.Request.Header.Del("Content-Encoding")
+	}
+
 	if err := c.Bind(&params); err != nil {
 		logrus.Infof("failed to bind data: %v", err)
 		f.Write(c, nil, 400, 0, "")
@@ -2,6 +2,7 @@ package controllers_test
 
 import (
 	"bytes"
+	"compress/gzip"
 	"crypto/rand"
 	"crypto/sha1"
 	"encoding/hex"
@@ -108,7 +109,7 @@ func createRandomFile(fileSize int64, chunkSize int64) (*os.File, controllers.Fi
 	return file, responseMeta
 }
 
-func uploadSlice(slice int64, meta controllers.FileMeta, file *os.File, assert *assert.Assertions) *httptest.ResponseRecorder {
+func newSliceRequest(slice int64, meta controllers.FileMeta, file *os.File, gzipped bool) *http.Request {
 	multipartBody := &bytes.Buffer{}
 	writer := multipart.NewWriter(multipartBody)
 	writer.WriteField("file_id", meta.FileId)
@@ -130,9 +131,25 @@ func uploadSlice(slice int64, meta controllers.FileMeta, file *os.File, assert *
 	io.ReadFull(fileReader, buf)
 	io.Copy(fileWriter, bytes.NewReader(buf))
 	writer.Close()
-	req, _ := http.NewRequest("POST", "/files/"+meta.FileId+"/upload", multipartBody)
+
+	var body io.Reader = multipartBody
+	if gzipped {
+		gzipBody := &bytes.Buffer{}
+		gzipWriter := gzip.NewWriter(gzipBody)
+		io.Copy(gzipWriter, multipartBody)
+		gzipWriter.Close()
+		body = gzipBody
+	}
+	req, _ := http.NewRequest("POST", "/files/"+meta.FileId+"/upload", body)
 	req.Header.Set("Content-Type", writer.FormDataContentType())
+	if gzipped {
+		req.Header.Set("Content-Encoding", "gzip")
+	}
+	return req
+}
 
+func uploadSlice(slice int64, meta controllers.FileMeta, file *os.File, gzipped bool, assert *assert.Assertions) *httptest.ResponseRecorder {
+	req := newSliceRequest(slice, meta, file, gzipped)
 	c, w := prepareContext(req)
 	r.HandleContext(c)
 	assert.True(w.Code == http.StatusOK || w.Code == http.StatusPartialContent)
@@ -244,7 +261,7 @@ func TestFileUploadSingle(t *testing.T) {
 	defer os.Remove(file.Name())
 
 	// upload
-	w := uploadSlice(0, responseMeta, file, assert)
+	w := uploadSlice(0, responseMeta, file, false, assert)
 	assert.Equal(http.StatusOK, w.Code)
 
 	// compare uploaded sha1
@@ -290,7 +307,7 @@ func TestFileUploadWithPrefix(t *testing.T) {
 
 	assert.Equal(http.StatusOK, w.Code)
 
-	uploadSlice(0, responseMeta, file, assert)
+	uploadSlice(0, responseMeta, file, false, assert)
 	assert.FileExists(path.Join(viper.GetString("uploader.upload_dir"), "test_prefix", responseMeta.FileName))
 }
 
@@ -304,7 +321,7 @@ func TestFildUploadMultipleSlices(t *testing.T) {
 	slicesDir := path.Join(viper.GetString("uploader.slice_cache_dir"), responseMeta.FileId)
 	for i := 0; i < slicesNum; i++ {
 		// upload
-		w := uploadSlice(int64(i), responseMeta, fileReader, assert)
+		w := uploadSlice(int64(i), responseMeta, fileReader, false, assert)
 
 		if i != slicesNum-1 {
 			assert.Equal(http.StatusPartialContent, w.Code)
@@ -343,8 +360,8 @@ func TestFileUploadInteruptResume(t *testing.T) {
 	file, responseMeta := createRandomFile(0, 0)
 	defer os.Remove(file.Name())
 
-	uploadSlice(0, responseMeta, file, assert)
-	uploadSlice(2, responseMeta, file, assert)
+	uploadSlice(0, responseMeta, file, false, assert)
+	uploadSlice(2, responseMeta, file, false, assert)
 
 	// get meta data
 	req, _ := http.NewRequest("GET", "/files/"+responseMeta.FileId+"/meta", nil)
@@ -372,7 +389,7 @@ func TestFileUploadInteruptResume(t *testing.T) {
 			continue
 		}
 		sliceId, _ := strconv.Atoi(slice.Id)
-		uploadSlice(int64(sliceId), responseMeta, file, assert)
+		uploadSlice(int64(sliceId), responseMeta, file, false, assert)
 	}
 
 	// all file uploaded
@@ -392,3 +409,50 @@ func TestFileUploadInteruptResume(t *testing.T) {
 	serverSha1Hex := hex.EncodeToString(serverSha1Sum[:])
 	assert.Equal(localSha1Hex, serverSha1Hex)
 }
+
+func TestFileUploadGzip(t *testing.T) {
+	assert := assert.New(t)
+	file, responseMeta := createRandomFile(0, 10*1024*1024)
+	defer os.Remove(file.Name())
+
+	w := uploadSlice(0, responseMeta, file, true, assert)
+	assert.Equal(http.StatusOK, w.Code)
+
+	// the stored file is the decompressed slice
+	fileContent := make([]byte, responseMeta.FileSize)
+	file.Seek(0, 0)
+	io.ReadFull(file, fileContent)
+	sha1Sum := sha1.Sum(fileContent)
+	sha1Hex := hex.EncodeToString(sha1Sum[:])
+	destFilePath := path.Join(viper.GetString("uploader.upload_dir"), responseMeta.FileName)
+	serverFileContent, _ := os.ReadFile(destFilePath)
+	sha1Sum = sha1.Sum(serverFileContent)
+	assert.Equal(sha1Hex, hex.EncodeToString(sha1Sum[:]))
+}
+
+func TestFileUploadCorruptGzip(t *testing.T) {
+	assert := assert.New(t)
+	file, responseMeta := createRandomFile(0, 0)
+	defer os.Remove(file.Name())
+
+	req, _ := http.NewRequest("POST", "/files/"+responseMeta.FileId+"/upload", bytes.NewBufferString("not gzip"))
+	req.Header.Set("Content-Type", "multipart/form-data; boundary=x")
+	req.Header.Set("Content-Encoding", "gzip")
+	c, w := prepareContext(req)
+	r.HandleContext(c)
+	assert.Equal(http.StatusBadRequest, w.Code)
+}
+
+func TestFileUploadGzipOverLimit(t *testing.T) {
+	assert := assert.New(t)
+	file, responseMeta := createRandomFile(3*1024*1024, 1024*1024)
+	defer os.Remove(file.Name())
+
+	// claim a bigger chunk so the slice inflates past the server's chunk size
+	oversizedMeta := responseMeta
+	oversizedMeta.ChunkSize = responseMeta.FileSize
+	req := newSliceRequest(0, oversizedMeta, file, true)
+	c, w := prepareContext(req)
+	r.HandleContext(c)
+	assert.Equal(http.StatusBadRequest, w.Code)
+}